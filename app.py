@@ -1,31 +1,157 @@
 from flask import Flask, request, send_file, jsonify
 from flask_cors import CORS
 import os
+import pathlib
+import functools
+import shutil
 import tempfile
 import hashlib
 import zipfile
 import json
+import logging
+import itertools
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 from io import BytesIO
 import genanki
+import httpx
 import re
+import unicodedata
 from lingua import Language, LanguageDetectorBuilder
 from elevenlabs.client import ElevenLabs
 from supabase import create_client, Client
 
 
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)
 
-supabase: Client = create_client(
-    os.environ.get("SUPABASE_URL"),
-    os.environ.get("SUPABASE_KEY")
+@functools.lru_cache(maxsize=None)
+def get_supabase() -> Client:
+    """Shared Supabase client; its PostgREST and Storage sessions are reused across requests"""
+    return create_client(
+        os.environ.get("SUPABASE_URL"),
+        os.environ.get("SUPABASE_KEY")
+    )
+
+@functools.lru_cache(maxsize=None)
+def get_http_client() -> httpx.Client:
+    """Keep-alive connection pool shared by ElevenLabs and public cache downloads"""
+    return httpx.Client(
+        timeout=60,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60)
+    )
+
+@functools.lru_cache(maxsize=None)
+def get_audio_disk_cache() -> sqlite3.Connection:
+    """Shared connection to the local audio cache; use it under _audio_disk_lock"""
+    connection = sqlite3.connect(AUDIO_DISK_CACHE_PATH, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS audio (hash TEXT PRIMARY KEY, blob BLOB)')
+    return connection
+
+@functools.lru_cache(maxsize=None)
+def get_elevenlabs() -> ElevenLabs:
+    """Shared ElevenLabs client backed by the shared connection pool"""
+    return ElevenLabs(
+        api_key=os.environ.get("ELEVENLABS_API_KEY"),
+        httpx_client=get_http_client()
+    )
+
+# When the audio-files bucket is public, cache hits are fetched from its CDN
+# URL instead of through the authenticated Storage API
+AUDIO_BUCKET_PUBLIC = os.environ.get('AUDIO_BUCKET_PUBLIC', '').lower() in ('1', 'true')
+
+# Cached files are content-addressed, so CDNs may keep them for a year
+AUDIO_CACHE_CONTROL_SECONDS = '31536000'
+
+# Concurrent ElevenLabs requests per deck, and the sustained request rate
+# shared by every deck being processed in this worker
+TTS_MAX_WORKERS = int(os.environ.get('TTS_MAX_WORKERS', 4))
+TTS_REQUESTS_PER_SECOND = float(os.environ.get('TTS_REQUESTS_PER_SECOND', 4))
+
+# ElevenLabs voice ("Rachel") and model used for every clip. The turbo model
+# has the lowest latency of the multilingual ones, and 32kbps 22kHz MP3 is
+# plenty for speech at a quarter of the default format's size.
+ELEVENLABS_VOICE_ID = "21m00Tcm4TlvDq8ikWAM"
+ELEVENLABS_MODEL_ID = "eleven_turbo_v2_5"
+ELEVENLABS_OUTPUT_FORMAT = "mp3_22050_32"
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+tts_rate_limiter = TokenBucket(TTS_REQUESTS_PER_SECOND, TTS_MAX_WORKERS)
+
+# TTS generations currently running in this worker, keyed by text hash
+_inflight_audio = {}
+_inflight_lock = threading.Lock()
+
+# Background deck processing jobs. They live in this process, so the deck
+# download must be served by the same gunicorn worker that ran the job.
+JOB_TTL_SECONDS = 3600
+_job_executor = ThreadPoolExecutor(max_workers=2)
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+# Hashes per audio_cache query, and parallel Storage downloads for the hits
+CACHE_LOOKUP_CHUNK_SIZE = 200
+CACHE_DOWNLOAD_WORKERS = 8
+
+# Recently used clips kept in memory in front of Supabase (~50MB at 100KB/clip)
+AUDIO_MEMORY_CACHE_SIZE = 512
+_audio_memory = OrderedDict()
+_audio_memory_lock = threading.Lock()
+
+# Local SQLite cache between the in-memory LRU and Supabase. It lives in the
+# container's temp dir, so it only survives until the next deploy or restart.
+AUDIO_DISK_CACHE_PATH = os.environ.get(
+    'AUDIO_DISK_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'audio_cache.sqlite')
 )
+AUDIO_DISK_CACHE_SIZE = int(os.environ.get('AUDIO_DISK_CACHE_SIZE', 5000))
+AUDIO_DISK_CACHE_TRIM_EVERY = 100
+_audio_disk_lock = threading.Lock()
+_audio_disk_writes = itertools.count(1)
 
-elevenlabs_client = ElevenLabs(
-    api_key=os.environ.get("ELEVENLABS_API_KEY")
-)
+# Storage uploads of freshly generated audio, overlapped with synthesis
+CACHE_UPLOAD_WORKERS = 8
+_upload_executor = ThreadPoolExecutor(max_workers=CACHE_UPLOAD_WORKERS)
 
-detector = LanguageDetectorBuilder.from_all_languages().build()
+# Waits for each deck's uploads and records them, off the request path. Kept
+# separate from the upload pool so it can never block the uploads it awaits.
+_cache_record_executor = ThreadPoolExecutor(max_workers=1)
 
 LANGUAGE_MAP = {
     'en': Language.ENGLISH,
@@ -62,129 +188,422 @@ LANGUAGE_MAP = {
     'vi': Language.VIETNAMESE,
 }
 
-def detect_field_language(text):
-    """Detects the language of a text field"""
-    if not text or len(text.strip()) == 0:
-        return None
+CODE_BY_LANGUAGE = {lang: code for code, lang in LANGUAGE_MAP.items()}
+
+# Low accuracy mode only uses trigrams: much faster and lighter, but noticeably
+# worse on single words, which many cards are. Opt-in for that reason.
+LINGUA_LOW_ACCURACY = os.environ.get('LINGUA_LOW_ACCURACY', '').lower() in ('1', 'true')
+
+@functools.lru_cache(maxsize=None)
+def get_detector(languages):
+    """Build (once per language set) a detector restricted to the given languages
+
+    Models are loaded up front so the first request using a detector doesn't
+    stall on lazy loading halfway through a deck.
+    """
+    builder = LanguageDetectorBuilder.from_languages(*languages).with_preloaded_language_models()
+    if LINGUA_LOW_ACCURACY:
+        builder = builder.with_low_accuracy_mode()
+    return builder.build()
+
+# Languages from LANGUAGE_MAP written in each non-Latin script, keyed by the
+# first word of the Unicode character name
+SCRIPT_LANGUAGES = {
+    'HANGUL': frozenset({Language.KOREAN}),
+    'HIRAGANA': frozenset({Language.JAPANESE}),
+    'KATAKANA': frozenset({Language.JAPANESE}),
+    'KATAKANA-HIRAGANA': frozenset({Language.JAPANESE}),
+    'CJK': frozenset({Language.CHINESE, Language.JAPANESE}),
+    'CYRILLIC': frozenset({Language.RUSSIAN, Language.UKRAINIAN, Language.BULGARIAN}),
+    'GREEK': frozenset({Language.GREEK}),
+    'ARABIC': frozenset({Language.ARABIC}),
+    'DEVANAGARI': frozenset({Language.HINDI}),
+    'TAMIL': frozenset({Language.TAMIL}),
+}
+
+# Everything else in LANGUAGE_MAP is written in Latin script. Knowing that lets
+# a field be rejected as the target without Lingua, e.g. Latin text in an
+# English/Japanese deck can only be English.
+SCRIPT_LANGUAGES['LATIN'] = frozenset(LANGUAGE_MAP.values()).difference(*SCRIPT_LANGUAGES.values())
+
+# Leading characters (spaces and punctuation included) whose letters are
+# inspected when guessing a language from its script
+SCRIPT_SAMPLE_CHARS = 100
+
+# Lingua's accuracy saturates long before this, so longer fields are cut down
+# to their head plus a short tail (to catch code-switched endings)
+DETECTION_HEAD_CHARS = 300
+DETECTION_TAIL_CHARS = 100
+
+@functools.lru_cache(maxsize=8192)
+def char_script(char):
+    """Script of a character, e.g. 'LATIN', 'CYRILLIC' or 'CJK'"""
+    return unicodedata.name(char, '').split(' ', 1)[0]
+
+def guess_language_from_script(text, languages):
+    """Resolve text written in a single-language script without running Lingua
+
+    Returns None when the script doesn't settle the language among `languages`
+    (Latin text with several Latin candidates, mixed scripts, Cyrillic with
+    several Cyrillic candidates...).
+    """
+    candidates = None
+    for char in text[:SCRIPT_SAMPLE_CHARS]:
+        if not char.isalpha():
+            continue
+
+        script_languages = SCRIPT_LANGUAGES.get(char_script(char))
+        if script_languages is None:
+            return None
 
-    clean_text = re.sub('<[^<]+?>', '', text)
+        candidates = script_languages if candidates is None else candidates & script_languages
 
-    if len(clean_text.strip()) == 0:
+    if not candidates:
         return None
 
-    detected = detector.detect_language_of(clean_text)
-    return detected
+    candidates = candidates & languages
+    if len(candidates) == 1:
+        return next(iter(candidates))
 
-def generate_audio_hash(text):
-    """Generate hash for text to use as cache key"""
-    return hashlib.md5(text.encode('utf-8')).hexdigest()
+    return None
+
+def detection_sample(text):
+    """Part of a field that is fed to Lingua"""
+    if len(text) <= DETECTION_HEAD_CHARS + DETECTION_TAIL_CHARS:
+        return text
+
+    return f"{text[:DETECTION_HEAD_CHARS]} {text[-DETECTION_TAIL_CHARS:]}"
+
+def detect_field_languages(texts, languages):
+    """Detects the languages of a batch of cleaned text fields
+
+    Fields whose script already settles the language skip Lingua; the rest
+    are detected in one parallel batch.
+    """
+    results = [guess_language_from_script(text, languages) for text in texts]
+
+    pending = [i for i, detected in enumerate(results) if detected is None]
+    if pending:
+        detected_langs = get_detector(languages).detect_languages_in_parallel_of([detection_sample(texts[i]) for i in pending])
+        for i, detected in zip(pending, detected_langs):
+            results[i] = detected
+
+    return results
 
+_TAG_RE = re.compile(r'<[^<]+?>')
+_SOUND_RE = re.compile(r'\[sound:[^\]]+\]')
 
-def get_cached_audio(text_hash):
-    """Check if audio exists in Supabase Storage"""
+@functools.lru_cache(maxsize=4096)
+def clean_field_text(field):
+    """Strip HTML tags, existing [sound:...] references and surrounding whitespace from a note field"""
+    return _SOUND_RE.sub('', _TAG_RE.sub('', field)).strip()
+
+@functools.lru_cache(maxsize=4096)
+def generate_audio_hash(text):
+    """Generate hash for text to use as cache key
+
+    Keys are prefixed so BLAKE2b entries never mix with legacy MD5 ones, which
+    can be pruned with `text_hash NOT LIKE 'b2-%'`.
+    """
+    return 'b2-' + hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def recall_audio(text_hash):
+    """Return audio from the in-memory LRU cache, or None"""
+    with _audio_memory_lock:
+        audio_data = _audio_memory.get(text_hash)
+        if audio_data is not None:
+            _audio_memory.move_to_end(text_hash)
+        return audio_data
+
+def remember_audio(text_hash, audio_data):
+    """Add audio to the in-memory LRU cache, evicting the least recently used"""
+    with _audio_memory_lock:
+        _audio_memory[text_hash] = audio_data
+        _audio_memory.move_to_end(text_hash)
+        while len(_audio_memory) > AUDIO_MEMORY_CACHE_SIZE:
+            _audio_memory.popitem(last=False)
+
+def recall_audio_from_disk(text_hashes):
+    """Return a dict of text_hash -> audio bytes for hashes in the local cache"""
+    found = {}
     try:
-        result = supabase.table('audio_cache').select('*').eq('text_hash', text_hash).execute()
-        if result.data and len(result.data) > 0:
-            file_path = result.data[0]['file_path']
-            audio_data = supabase.storage.from_('audio-files').download(file_path)
-            return audio_data
-        return None
+        with _audio_disk_lock:
+            connection = get_audio_disk_cache()
+            for start in range(0, len(text_hashes), CACHE_LOOKUP_CHUNK_SIZE):
+                chunk = text_hashes[start:start + CACHE_LOOKUP_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(connection.execute(
+                    f'SELECT hash, blob FROM audio WHERE hash IN ({placeholders})', chunk
+                ))
+    except sqlite3.Error as e:
+        logger.warning('Local cache lookup error: %s', e)
+    return found
+
+def store_audio_on_disk(text_hash, audio_data):
+    """Add audio to the local cache, trimming it to the newest entries now and then"""
+    try:
+        with _audio_disk_lock:
+            connection = get_audio_disk_cache()
+            with connection:
+                connection.execute(
+                    'INSERT OR IGNORE INTO audio (hash, blob) VALUES (?, ?)', (text_hash, audio_data)
+                )
+                if next(_audio_disk_writes) % AUDIO_DISK_CACHE_TRIM_EVERY == 0:
+                    connection.execute(
+                        'DELETE FROM audio WHERE rowid NOT IN '
+                        '(SELECT rowid FROM audio ORDER BY rowid DESC LIMIT ?)',
+                        (AUDIO_DISK_CACHE_SIZE,)
+                    )
+    except sqlite3.Error as e:
+        logger.warning('Local cache storage error: %s', e)
+
+def download_cached_audio(file_path):
+    """Download one cached audio file from Supabase Storage"""
+    try:
+        if AUDIO_BUCKET_PUBLIC:
+            public_url = get_supabase().storage.from_('audio-files').get_public_url(file_path)
+            response = get_http_client().get(public_url)
+            response.raise_for_status()
+            return response.content
+
+        return get_supabase().storage.from_('audio-files').download(file_path)
     except Exception as e:
-        print(f'Cache lookup error: {e}')
+        logger.warning('Cache download error: %s', e)
         return None
 
-def cache_audio(text_hash, text, audio_data, language):
-    """Store audio in supabase storage"""
+def get_cached_audio_batch(text_hashes):
+    """Look up many hashes in Supabase at once and download the hits in parallel
+
+    Hashes held in the in-memory LRU or the local disk cache skip Supabase
+    entirely. Returns a dict of text_hash -> audio bytes for every hash found
+    in any cache.
+    """
+    cached = {}
+    not_in_memory = []
+    for text_hash in text_hashes:
+        audio_data = recall_audio(text_hash)
+        if audio_data is not None:
+            cached[text_hash] = audio_data
+        else:
+            not_in_memory.append(text_hash)
+
+    on_disk = recall_audio_from_disk(not_in_memory)
+    for text_hash, audio_data in on_disk.items():
+        remember_audio(text_hash, audio_data)
+        cached[text_hash] = audio_data
+    missing = [text_hash for text_hash in not_in_memory if text_hash not in on_disk]
+
+    downloads = {}
+    with ThreadPoolExecutor(max_workers=CACHE_DOWNLOAD_WORKERS) as executor:
+        # Chunked so the PostgREST query string stays a reasonable length; each
+        # chunk's hits start downloading while the next chunk is queried
+        for start in range(0, len(missing), CACHE_LOOKUP_CHUNK_SIZE):
+            chunk = missing[start:start + CACHE_LOOKUP_CHUNK_SIZE]
+            try:
+                result = get_supabase().table('audio_cache').select('text_hash,file_path').in_('text_hash', chunk).execute()
+            except Exception as e:
+                logger.warning('Cache lookup error: %s', e)
+                continue
+
+            for row in result.data:
+                downloads[row['text_hash']] = executor.submit(download_cached_audio, row['file_path'])
+
+        for text_hash, download in downloads.items():
+            audio_data = download.result()
+            if audio_data:
+                remember_audio(text_hash, audio_data)
+                store_audio_on_disk(text_hash, audio_data)
+                cached[text_hash] = audio_data
+
+    return cached
+
+def upload_audio(text_hash, text, audio_data, language):
+    """Store audio in supabase storage
+
+    Returns the audio_cache row to insert for it, or None if the upload failed.
+    """
     try:
         filename = f"{text_hash}.mp3"
 
-        supabase.storage.from_('audio-files').upload(
+        get_supabase().storage.from_('audio-files').upload(
             filename,
             audio_data,
-            {'content-type': 'audio/mpeg'}
+            {'content-type': 'audio/mpeg', 'cache-control': AUDIO_CACHE_CONTROL_SECONDS}
         )
 
-        supabase.table('audio_cache').insert({
+        return {
             'text_hash': text_hash,
             'text': text[:500],
             'file_path': filename,
             'language': language
-        }).execute()
+        }
 
     except Exception as e:
-        print(f'Cache storage error: {e}')
+        logger.warning('Cache storage error: %s', e)
+        return None
+
+def insert_cache_rows(rows):
+    """Record uploaded audio in the audio_cache table with a single bulk insert
+
+    Rows another request already recorded are skipped rather than failing the
+    whole batch.
+    """
+    if not rows:
+        return
+
+    try:
+        get_supabase().table('audio_cache').upsert(rows, on_conflict='text_hash', ignore_duplicates=True).execute()
+    except Exception as e:
+        logger.warning('Cache insert error: %s', e)
+
+def record_uploads(uploads):
+    """Wait for a deck's cache uploads, then record them all in one insert"""
+    wait(uploads)
+    insert_cache_rows([upload.result() for upload in uploads if upload.result()])
 
 def generate_audio_elevenlabs(text, language):
     """Generate audio using eleven labs API"""
 
+    tts_rate_limiter.acquire()
+
     try:
-        audio_generator = elevenlabs_client.text_to_speech.convert_as_stream(
-            voice_id="21m00Tcm4TlvDq8ikWAM",
+        audio_generator = get_elevenlabs().text_to_speech.convert_as_stream(
+            voice_id=ELEVENLABS_VOICE_ID,
             text=text,
-            model_id="eleven_turbo_v2_5",
+            model_id=ELEVENLABS_MODEL_ID,
+            output_format=ELEVENLABS_OUTPUT_FORMAT,
             language_code=language
         )
 
-        audio_bytes = b''.join(audio_generator)
-        return audio_bytes
+        # Append chunks to one growing buffer as they arrive
+        buffer = BytesIO()
+        for chunk in audio_generator:
+            buffer.write(chunk)
+
+        return buffer.getvalue()
     except Exception as e:
-        print(f"ElevenLabs error: {e}")
+        logger.error("ElevenLabs error: %s", e)
         return None
 
 
-def analyze_deck(apkg_file, native_language):
-    """Analyze anki deck to give the user a preview of what will be created"""
+def generate_and_cache_audio(text_hash, text, language, uploads):
+    """Generate audio for text and queue it for caching, returning the bytes
+
+    The cache upload runs on the upload pool so this TTS slot is free for the
+    next clip right away; its future is appended to `uploads`. Concurrent
+    calls for the same hash (e.g. two decks sharing a phrase) wait for the
+    first one instead of paying for a second TTS call.
+    """
+    with _inflight_lock:
+        future = _inflight_audio.get(text_hash)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight_audio[text_hash] = future
+
+    if not is_owner:
+        logger.debug("Waiting on in-flight audio for %.50r", text)
+        return future.result()
+
+    try:
+        audio_data = generate_audio_elevenlabs(text, language)
+
+        if audio_data:
+            logger.debug("Audio generated for %.50r, size: %d bytes", text, len(audio_data))
+            remember_audio(text_hash, audio_data)
+            store_audio_on_disk(text_hash, audio_data)
+            uploads.append(_upload_executor.submit(upload_audio, text_hash, text, audio_data, language))
+        else:
+            logger.error("Audio generation failed for %.50r", text)
 
-    import sqlite3
+        future.set_result(audio_data)
+        return audio_data
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight_audio[text_hash]
 
-    print(f"analyze the deck called")
-    print(f"Native language: {native_language}")
+
+def analyze_deck(apkg_file, native_language, target_language=None):
+    """Analyze anki deck to give the user a preview of what will be created
+
+    Args:
+        apkg_file: Path or seekable binary file object of the uploaded .apkg
+        native_language: Language code of the user's native language
+        target_language: Optional language code audio will be generated in
+    """
+
+    logger.info("Analyzing deck, native language: %s", native_language)
 
     native_lang = LANGUAGE_MAP.get(native_language)
 
     if not native_lang:
         raise ValueError(f"Unsupported native language code: {native_language}")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        print(f"Created temporary directory: {temp_dir}")
+    # Only score the two languages we actually compare against; fall back to
+    # every supported language when no distinct target was given
+    target_lang = LANGUAGE_MAP.get(target_language)
+    if target_lang and target_lang != native_lang:
+        languages = frozenset((native_lang, target_lang))
+    else:
+        languages = frozenset(LANGUAGE_MAP.values())
 
-        apkg_path = os.path.join(temp_dir, 'deck.apkg')
-        with open(apkg_path, 'wb') as f:
-            f.write(apkg_file)
+    with tempfile.TemporaryDirectory() as temp_dir:
 
-        extract_dir = os.path.join(temp_dir, 'extracted')
-        os.makedirs(extract_dir)
+        # Only the collection database is read; media files are never extracted
+        with zipfile.ZipFile(apkg_file, 'r') as zip_ref:
+            names = zip_ref.namelist()
+            logger.debug("Files in .apkg: %s", names)
 
-        with zipfile.ZipFile(apkg_path, 'r') as zip_ref:
-            print(f"files in .apkg: {zip_ref.namelist()}")
-            zip_ref.extractall(extract_dir)
+            if 'collection.anki21' in names:
+                db_name = 'collection.anki21'
+                logger.debug("Using collection.anki21")
+            else:
+                db_name = 'collection.anki2'
+                logger.debug("Using collection.anki2 fallback")
 
-        files_in_extract = os.listdir(extract_dir)
-        print(f"Extracted files: {files_in_extract}")
+            if db_name not in names:
+                raise ValueError("No Anki collection found in the uploaded .apkg")
 
-        db_path = os.path.join(extract_dir, 'collection.anki21')
-        if not os.path.exists(db_path):
-            db_path = os.path.join(extract_dir, 'collection.anki2')
-            print(f"Using collection.anki2 fallback")
-        else:
-            print(f"Using collection.anki21")
+            db_path = zip_ref.extract(db_name, temp_dir)
 
-        print(f"Database path: {db_path}, exists: {os.path.exists(db_path)}")
-        conn = sqlite3.connect(db_path)
+        # Private temp copy nobody else writes to: open it read-only and
+        # immutable so SQLite skips locking and journal checks
+        conn = sqlite3.connect(f"{pathlib.Path(db_path).as_uri()}?mode=ro&immutable=1", uri=True)
         cursor = conn.cursor()
 
-        cursor.execute("SELECT id, flds FROM notes")
-        notes = cursor.fetchall()
-        print(f"Found {len(notes)} notes in deck")
+        cards_data = []
+        uncertain_count = 0
+
+        # Strip every field first so the whole deck is detected in one
+        # parallel batch instead of one detector call per field. Rows are
+        # streamed from the cursor; only the cleaned fields are kept.
+        notes_fields = []
+        unique_texts = {}
+        field_count = 0
+        for note_id, fields_str in cursor.execute("SELECT id, flds FROM notes"):
+            clean_fields = []
+            for i, field in enumerate(fields_str.split('\x1f')):
+                clean_text = clean_field_text(field)
+                if clean_text:
+                    clean_fields.append((i, clean_text))
+                    unique_texts[clean_text] = None
+                    field_count += 1
+            notes_fields.append((note_id, clean_fields))
 
         conn.close()
+        logger.info("Found %d notes in deck", len(notes_fields))
 
-        cards_data = []
-        uncertain_count = 0
+        # Duplicate field text (shared examples, reversed notes) is detected once
+        unique_texts = list(unique_texts)
+        logger.info("Detecting languages of %d unique fields (%d total)", len(unique_texts), field_count)
+        detected_by_text = dict(zip(unique_texts, detect_field_languages(unique_texts, languages)))
 
-        for note_id, fields_str in notes:
-            fields = fields_str.split('\x1f')
-            print(f"\nNote {note_id}: {len(fields)} fields")
+        for note_id, clean_fields in notes_fields:
+            logger.debug("Note %s: %d non-empty fields", note_id, len(clean_fields))
 
             field_data = []
             foreign_text = None
@@ -192,21 +611,11 @@ def analyze_deck(apkg_file, native_language):
             foreign_detected_lang = None
             is_uncertain = False
 
-            for i, field in enumerate(fields):
-                clean_text = re.sub('<[^<]+?>', '', field).strip()
-
-                if not clean_text:
-                    continue
+            for i, clean_text in clean_fields:
+                detected_lang = detected_by_text[clean_text]
 
-                detected_lang = detect_field_language(clean_text)
-
-                detected_lang_code = None
-                if detected_lang:
-                    for code, lang in LANGUAGE_MAP.items():
-                        if lang == detected_lang:
-                            detected_lang_code = code
-                            break
-                print(f"Field {i}: '{clean_text[:50]}...' -> detected: {detected_lang}")
+                detected_lang_code = CODE_BY_LANGUAGE.get(detected_lang)
+                logger.debug("Field %d: %.50r -> detected: %s", i, clean_text, detected_lang)
 
                 field_data.append({
                     'text': clean_text,
@@ -217,17 +626,17 @@ def analyze_deck(apkg_file, native_language):
                 if detected_lang == native_lang:
                     if not native_text:
                         native_text = clean_text
-                        print(f"✓ Found native language field ({native_language}) - NO AUDIO")
+                        logger.debug("Found native language field (%s) - no audio", native_language)
                 else:
                     if not foreign_text:
                         foreign_text = clean_text
                         foreign_detected_lang = detected_lang_code
-                        print(f"✓ Found non-native field - WILL GENERATE AUDIO")
+                        logger.debug("Found non-native field - will generate audio")
 
             if not foreign_text or not native_text:
                 is_uncertain = True
                 uncertain_count += 1
-                print(f"⚠ UNCERTAIN: Could not identify clear foreign/native text split")  # FIXED: Syntax error
+                logger.debug("Uncertain: could not identify clear foreign/native text split")
 
                 if len(field_data) >= 2:
                     foreign_text = field_data[0]['text']
@@ -244,7 +653,7 @@ def analyze_deck(apkg_file, native_language):
                     'all_fields': field_data
                 })
 
-        print(f"\nAnalysis complete: {len(cards_data)} cards, {uncertain_count} uncertain")
+        logger.info("Analysis complete: %d cards, %d uncertain", len(cards_data), uncertain_count)
 
         return {
             'total_cards': len(cards_data),
@@ -252,27 +661,16 @@ def analyze_deck(apkg_file, native_language):
             'cards': cards_data
         }
 
-# FIXED: Changed function signature to accept cards_data instead of apkg_file
-def process_deck(cards_data, target_language, native_language):
-    """Process cards with user-corrected languages and generate audio
+@functools.lru_cache(maxsize=64)
+def get_practice_deck_id(target_language, native_language):
+    """Stable deck id per language pair, so re-imports merge into the same deck"""
+    return int(hashlib.md5(f"audio_practice_{target_language}_{native_language}".encode(), usedforsecurity=False).hexdigest()[:8], 16)
 
-    Args:
-        cards_data: List of card objects with corrected languages from frontend
-        target_language: Language code for audio generation
-        native_language: Language code for native language
-    """
-
-    print(f"=== process_deck called ===")
-    print(f"Target language (for audio): {target_language}")
-    print(f"Native language (no audio): {native_language}")
-    print(f"Processing {len(cards_data)} cards")
-
-    # Create deck directly from card data
-    deck_id = int(hashlib.md5(f"audio_practice_{target_language}_{native_language}".encode()).hexdigest()[:8], 16)
-    deck = genanki.Deck(deck_id, f"Audio Practice Deck ({target_language.upper()} - {native_language.upper()})")
-
-    model_id = int(hashlib.md5(f"audio_practice_model_{target_language}_{native_language}".encode()).hexdigest()[:8], 16)
-    model = genanki.Model(
+@functools.lru_cache(maxsize=64)
+def get_practice_model(target_language, native_language):
+    """Note model for the generated deck, built once per language pair"""
+    model_id = int(hashlib.md5(f"audio_practice_model_{target_language}_{native_language}".encode(), usedforsecurity=False).hexdigest()[:8], 16)
+    return genanki.Model(
         model_id,
         'Audio Practice Model',
         fields=[
@@ -288,33 +686,103 @@ def process_deck(cards_data, target_language, native_language):
             }
         ])
 
+def write_apkg(deck, media_files_data, output_path):
+    """Write a deck and its in-memory media files to an .apkg
+
+    Same layout as genanki.Package.write_to_file, but only the collection and
+    media manifest are deflated; MP3s are already compressed so they are
+    stored as-is and written straight from memory.
+    """
+    db_path = f"{output_path}.collection"
+    conn = sqlite3.connect(db_path)
+    # Throwaway file that is zipped and deleted, so skip fsyncs and the rollback journal
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA journal_mode=MEMORY")
+    timestamp = time.time()
+    genanki.Package(deck).write_to_db(conn.cursor(), timestamp, itertools.count(int(timestamp * 1000)))
+    conn.commit()
+    conn.close()
+
+    filenames = list(media_files_data)
+    with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as outzip:
+        outzip.write(db_path, 'collection.anki2')
+        outzip.writestr('media', json.dumps({str(idx): filename for idx, filename in enumerate(filenames)}))
+
+        for idx, filename in enumerate(filenames):
+            outzip.writestr(str(idx), media_files_data[filename], compress_type=zipfile.ZIP_STORED)
+
+    os.remove(db_path)
+
+# FIXED: Changed function signature to accept cards_data instead of apkg_file
+def process_deck(cards_data, target_language, native_language, output_dir, on_progress=None):
+    """Process cards with user-corrected languages and generate audio
+
+    Args:
+        cards_data: List of card objects with corrected languages from frontend
+        target_language: Language code for audio generation
+        native_language: Language code for native language
+        output_dir: Directory to write the package into, owned by the caller
+        on_progress: Optional callback taking (percent, message)
+
+    Returns:
+        Tuple of (path to the written .apkg, number of cards created)
+    """
+
+    logger.info("Processing %d cards, target language (audio): %s, native language (no audio): %s",
+                len(cards_data), target_language, native_language)
+
+    def report(percent, message):
+        if on_progress:
+            on_progress(percent, message)
+
+    # Create deck directly from card data
+    deck = genanki.Deck(get_practice_deck_id(target_language, native_language),
+                        f"Audio Practice Deck ({target_language.upper()} - {native_language.upper()})")
+    model = get_practice_model(target_language, native_language)
+
     media_files_data = {}
     cards_created = 0
 
-    # Process each card from frontend data
-    for card in cards_data:
+    # Decks often repeat a phrase, so look up and generate each text only once
+    card_hashes = [generate_audio_hash(card['foreign_text']) for card in cards_data]
+    unique_texts = dict(zip(card_hashes, (card['foreign_text'] for card in cards_data)))
+    logger.info("%d unique texts across %d cards", len(unique_texts), len(cards_data))
+
+    # Look up cached audio first; only the misses go to ElevenLabs
+    audio_by_hash = get_cached_audio_batch(list(unique_texts))
+    logger.info("Found %d cached audio clips", len(audio_by_hash))
+    report(10, f"Found {len(audio_by_hash)} cached audio clips")
+
+    to_generate = [(text_hash, text) for text_hash, text in unique_texts.items() if text_hash not in audio_by_hash]
+
+    # TTS calls are network-bound, so run them concurrently
+    logger.info("Generating %d new audio clips with ElevenLabs in %s", len(to_generate), target_language)
+    uploads = []
+    if to_generate:
+        with ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(generate_and_cache_audio, text_hash, text, target_language, uploads): text_hash
+                for text_hash, text in to_generate
+            }
+            # Collect clips as they finish so one slow clip doesn't stall progress
+            for done, future in enumerate(as_completed(futures), start=1):
+                audio_data = future.result()
+                if audio_data:
+                    audio_by_hash[futures[future]] = audio_data
+                report(10 + 80 * done // len(futures), f"Generated audio {done}/{len(futures)}")
+
+    # The deck doesn't need the cache writes, so finish them in the background
+    if uploads:
+        _cache_record_executor.submit(record_uploads, uploads)
+
+    # Build notes in the original card order
+    for card, text_hash in zip(cards_data, card_hashes):
         foreign_text = card['foreign_text']
         native_text = card['native_text']
 
-        print(f"\nProcessing card: '{foreign_text[:50]}...'")
-
-        text_hash = generate_audio_hash(foreign_text)
         audio_filename = f"{text_hash}.mp3"
 
-        audio_data = get_cached_audio(text_hash)
-
-        if not audio_data:
-            print(f"  Generating new audio with ElevenLabs in {target_language}...")
-            audio_data = generate_audio_elevenlabs(foreign_text, target_language)
-
-            if audio_data:
-                print(f"  Audio generated! Size: {len(audio_data)} bytes")
-                cache_audio(text_hash, foreign_text, audio_data, target_language)
-            else:
-                print(f"  ERROR: Audio generation failed!")
-                continue
-        else:
-            print(f"  Using cached audio, size: {len(audio_data)} bytes")
+        audio_data = audio_by_hash.get(text_hash)
 
         if audio_data:
             media_files_data[audio_filename] = audio_data
@@ -325,33 +793,50 @@ def process_deck(cards_data, target_language, native_language):
             )
             deck.add_note(note)
             cards_created += 1
-            print(f"  Card created!")
+        else:
+            logger.warning("Skipping card without audio: %.50r", foreign_text)
 
-    print(f"\nTotal cards created: {cards_created}")
+    logger.info("Total cards created: %d", cards_created)
 
     # Package the deck
-    with tempfile.TemporaryDirectory() as temp_dir:
-        package = genanki.Package(deck)
-
-        media_dir = os.path.join(temp_dir, 'media')
-        os.makedirs(media_dir)
+    report(95, "Packaging deck...")
+    output_path = os.path.join(output_dir, 'audio_practice.apkg')
+    write_apkg(deck, media_files_data, output_path)
 
-        media_file_paths = []
-        for filename, data in media_files_data.items():
-            file_path = os.path.join(media_dir, filename)
-            with open(file_path, 'wb') as f:
-                f.write(data)
-            media_file_paths.append(file_path)
+    return output_path, cards_created
 
-        package.media_files = media_file_paths
+def update_job(job_id, **fields):
+    """Update the stored state of a background job"""
+    with _jobs_lock:
+        _jobs[job_id].update(fields)
 
-        output_path = os.path.join(temp_dir, 'audio_practice.apkg')
-        package.write_to_file(output_path)
+def run_process_job(job_id, cards_data, target_language, native_language, output_dir):
+    """Run process_deck for a queued job and record the outcome"""
+    update_job(job_id, status='running', message='Looking up cached audio...')
 
-        with open(output_path, 'rb') as f:
-            output_data = f.read()
-
-        return output_data, cards_created
+    try:
+        output_path, cards_created = process_deck(
+            cards_data, target_language, native_language, output_dir,
+            on_progress=lambda percent, message: update_job(job_id, progress=percent, message=message)
+        )
+        logger.info("Job %s complete, created %d cards", job_id, cards_created)
+        update_job(job_id, status='done', progress=100, message='Complete!',
+                   output_path=output_path, cards_created=cards_created)
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        update_job(job_id, status='error', message=str(e))
+
+def expire_jobs():
+    """Drop finished jobs (and their files) that were never downloaded"""
+    now = time.time()
+    with _jobs_lock:
+        expired = [
+            job_id for job_id, job in _jobs.items()
+            if job['status'] in ('done', 'error') and now - job['created_at'] > JOB_TTL_SECONDS
+        ]
+        for job_id in expired:
+            shutil.rmtree(_jobs.pop(job_id)['output_dir'], ignore_errors=True)
 
 @app.route('/')
 def home():
@@ -362,26 +847,24 @@ def home():
 def analyze():
     """Analyze deck and return cards to user for preview before processing"""
     try:
-        print("=== Analyze request received ===")
-        print(f"Request files: {request.files}")
-        print(f"Request form: {request.form}")
+        logger.info("Analyze request received")
 
         if 'file' not in request.files:
             return jsonify({"status": "error", "message": "No file uploaded"}), 400
 
         file = request.files['file']
         native_language = request.form.get('native_language', 'en')
+        target_language = request.form.get('target_language')
 
-        print(f"File: {file.filename}")
-        print(f"Native Language: {native_language}")
+        logger.info("File: %s, native language: %s, target language: %s", file.filename, native_language, target_language)
 
-        file_data = file.read()
-        print(f"File size: {len(file_data)} bytes")
+        # Werkzeug has already spooled the upload; read the zip straight from
+        # that stream instead of copying the whole deck into memory
+        file.stream.seek(0, os.SEEK_END)
+        logger.info("File size: %d bytes", file.stream.tell())
+        file.stream.seek(0)
 
-        print("Analyzing deck...")
-        analysis_result = analyze_deck(file_data, native_language)
-
-        print(f"Analysis complete: {analysis_result['total_cards']} cards analyzed")
+        analysis_result = analyze_deck(file.stream, native_language, target_language)
 
         return jsonify({
             "status": "success",
@@ -389,17 +872,15 @@ def analyze():
         })
 
     except Exception as e:
-        print(f"ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Request failed")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # MODIFIED: /api/process now accepts JSON with cards data
 @app.route('/api/process', methods=['POST'])
 def process():
-    """Process cards with user-corrected languages and generate audio"""
+    """Queue cards with user-corrected languages for audio generation"""
     try:
-        print("=== Process request received ===")
+        logger.info("Process request received")
 
         # Accept JSON data instead of form data
         data = request.get_json()
@@ -408,36 +889,74 @@ def process():
         target_language = data.get('target_language')
         native_language = data.get('native_language', 'en')
 
-        print(f"Target Language (audio): {target_language}")
-        print(f"Native Language (no audio): {native_language}")
-        print(f"Cards to process: {len(cards_data)}")
+        logger.info("Target language (audio): %s, native language (no audio): %s, cards: %d",
+                    target_language, native_language, len(cards_data))
 
         if not target_language:
-            print("ERROR: No target language specified")
+            logger.warning("No target language specified")
             return jsonify({"status": "error", "message": "No target language specified"}), 400
 
         if not cards_data:
-            print("ERROR: No cards data provided")
+            logger.warning("No cards data provided")
             return jsonify({"status": "error", "message": "No cards data provided"}), 400
 
-        print("Processing deck...")
-        output_data, cards_created = process_deck(cards_data, target_language, native_language)
+        expire_jobs()
+
+        job_id = uuid.uuid4().hex
+        output_dir = tempfile.mkdtemp()
+        with _jobs_lock:
+            _jobs[job_id] = {
+                'status': 'queued',
+                'progress': 0,
+                'message': 'Queued...',
+                'output_dir': output_dir,
+                'created_at': time.time(),
+            }
 
-        print(f"Processing complete! Created {cards_created} cards")
+        logger.info("Queueing job %s", job_id)
+        _job_executor.submit(run_process_job, job_id, cards_data, target_language, native_language, output_dir)
 
-        return send_file(
-            BytesIO(output_data),
-            mimetype='application/octet-stream',
-            as_attachment=True,
-            download_name='audio_practice_deck.apkg'
-        )
+        return jsonify({"status": "accepted", "job_id": job_id}), 202
 
     except Exception as e:
-        print(f"ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Request failed")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/api/process/<job_id>', methods=['GET'])
+def process_status(job_id):
+    """Report the progress of a background processing job"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if not job:
+            return jsonify({"status": "error", "message": "Unknown job"}), 404
+
+        return jsonify({
+            "status": job['status'],
+            "progress": job['progress'],
+            "message": job['message'],
+            "cards_created": job.get('cards_created'),
+        })
+
+@app.route('/api/process/<job_id>/download', methods=['GET'])
+def process_download(job_id):
+    """Download the deck of a finished job; the job is removed once it is sent"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if not job or job['status'] != 'done':
+            return jsonify({"status": "error", "message": "Deck is not ready"}), 404
+
+        _jobs.pop(job_id)
+
+    # Stream the package from disk and only remove it once the response is done
+    response = send_file(
+        job['output_path'],
+        mimetype='application/octet-stream',
+        as_attachment=True,
+        download_name='audio_practice_deck.apkg'
+    )
+    response.call_on_close(lambda: shutil.rmtree(job['output_dir'], ignore_errors=True))
+    return response
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
@@ -3,11 +3,18 @@ import multiprocessing
 # Worker timeout - set to 10 minutes for audio generation
 timeout = 600
 
-# Number of worker processes
+# Number of worker processes. Kept at one: processing jobs, in-flight TTS
+# calls and the in-memory audio cache live in the worker process, so job
+# status and download requests must reach the worker that ran the job.
 workers = 1
 
-# Worker class
-worker_class = 'sync'
+# Worker class - requests are mostly waiting on ElevenLabs/Supabase, so one
+# process serves them concurrently from a thread pool instead of one at a time
+worker_class = 'gthread'
+threads = 16
+
+# Gunicorn's own log level; the app's level is set with LOG_LEVEL
+loglevel = 'info'
 
 # Bind to Railway's port
 bind = '0.0.0.0:8080'